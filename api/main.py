@@ -1,22 +1,30 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request
-from fastapi.responses import FileResponse, Response
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
 from rq import Queue
 import os
+import time
 import uuid
 import re
-import json
+import orjson
 from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
 
-app = FastAPI(title="StemTranscriber API")
+app = FastAPI(title="StemTranscriber API", default_response_class=ORJSONResponse)
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
 DATA_DIR = Path(os.getenv("DATA_DIR", "/data"))
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+RE_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
 redis_conn = Redis.from_url(REDIS_URL)
 q = Queue("default", connection=redis_conn)
+# non-blocking client for Redis-only endpoints (RQ itself needs the sync, bytes client)
+aioredis = AsyncRedis.from_url(REDIS_URL, decode_responses=True)
 
 def job_key(job_id: str) -> str:
     return f"stemtranscriber:job:{job_id}"
@@ -36,17 +44,97 @@ def transcriptions_dir(project_id: str) -> Path:
 def meta_path(project_id: str) -> Path:
     return project_dir(project_id) / "meta.json"
 
+@lru_cache(maxsize=4096)
+def _read_meta_cached(project_id: str, mtime_ns: int) -> dict:
+    # mtime_ns is part of the cache key: rewriting meta.json invalidates the entry.
+    # Errors propagate so a half-written file is never cached (lru_cache skips raises).
+    return orjson.loads(meta_path(project_id).read_bytes())
+
 def read_meta(project_id: str) -> dict | None:
-    p = meta_path(project_id)
-    if not p.exists():
-        return None
     try:
-        return json.loads(p.read_text())
+        st = meta_path(project_id).stat()
+        return _read_meta_cached(project_id, st.st_mtime_ns)
     except Exception:
         return None
 
+# Directory listings are cached by (path, dir mtime): adding/removing/renaming
+# an entry bumps the directory mtime, which naturally invalidates the entry.
+# Stems are only ever renamed into place, so their versions are cached with the listing too.
+@lru_cache(maxsize=1024)
+def _list_stems_versioned(sdir: str, mtime_ns: int) -> tuple[tuple[str, str], ...]:
+    items = []
+    for p in sorted(Path(sdir).glob("*.wav")):
+        try:
+            items.append((p.name, stem_version(p.stat())))
+        except OSError:
+            continue
+    return tuple(items)
+
+@lru_cache(maxsize=1024)
+def _list_transcription_names(tdir: str, mtime_ns: int) -> tuple[str, ...]:
+    return tuple(sorted(
+        p.name for p in Path(tdir).iterdir()
+        if p.is_file() and p.name.lower().endswith((".mid", ".midi", ".musicxml", ".xml"))
+    ))
+
+# "Racily clean" rule (as in git's index): directory mtimes move in coarse ticks, so
+# several renames can share one mtime. Don't cache a listing taken within that window.
+LISTING_RACY_WINDOW_NS = 1_000_000_000
+
+def cached_listing(listing, d: Path):
+    mtime_ns = d.stat().st_mtime_ns
+    if time.time_ns() - mtime_ns < LISTING_RACY_WINDOW_NS:
+        return listing.__wrapped__(str(d), mtime_ns)
+    return listing(str(d), mtime_ns)
+
 def write_meta(project_id: str, meta: dict):
-    meta_path(project_id).write_text(json.dumps(meta, ensure_ascii=False, indent=2))
+    meta_path(project_id).write_bytes(orjson.dumps(meta, option=orjson.OPT_INDENT_2))
+
+def enqueue_with_status(func: str, project_id: str, *args, message: str) -> str:
+    """
+    Queue `func(project_id, job_id, *args)` and write its status hash in one flush.
+    RQ turns the pipeline into MULTI/EXEC (so enqueue must be issued first), which also
+    makes the "queued" hset atomic with the enqueue: a worker can't have set "running" yet.
+    """
+    job_id = str(uuid.uuid4())
+    pipe = redis_conn.pipeline()
+    q.enqueue(func, project_id, job_id, *args, job_id=job_id, job_timeout=3600, pipeline=pipe)
+    pipe.hset(job_key(job_id), mapping={
+        "state": "queued",
+        "progress": 0,
+        "message": message,
+        "project_id": project_id
+    })
+    pipe.execute()
+    return job_id
+
+def iter_file_range(path: Path, start: int, end: int, block_size: int = 64 * 1024):
+    """Yield bytes [start, end] of a file in blocks of at most block_size."""
+    with path.open("rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(block_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+# immutable only for the versioned URLs list_stems hands out; bare URLs revalidate via ETag
+STEM_CACHE_CONTROL_VERSIONED = "public, max-age=31536000, immutable"
+STEM_CACHE_CONTROL_BARE = "no-cache"
+
+def stem_version(st: os.stat_result) -> str:
+    # stems are only ever replaced wholesale, so size + mtime identifies the content
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = (t.strip() for t in if_none_match.split(","))
+    return any(t.removeprefix("W/") == etag for t in tags)
 
 class CreateProjectRequest(BaseModel):
     name: str | None = None
@@ -132,8 +220,10 @@ async def upload_audio(project_id: str, audio: UploadFile = File(...)):
     ext = Path(audio.filename).suffix or ".wav"
     out_path = udir / f"original{ext}"
 
+    # Copy in bounded chunks so large WAVs never sit fully in memory
     with out_path.open("wb") as f:
-        f.write(await audio.read())
+        while chunk := await audio.read(UPLOAD_CHUNK_SIZE):
+            f.write(chunk)
 
     return UploadResponse(filename=out_path.name)
 
@@ -147,21 +237,7 @@ def separate(project_id: str):
     if not originals:
         raise HTTPException(status_code=400, detail="No uploaded audio found")
 
-    job_id = str(uuid.uuid4())
-    redis_conn.hset(job_key(job_id), mapping={
-        "state": "queued",
-        "progress": 0,
-        "message": "Separation queued",
-        "project_id": project_id
-    })
-
-    q.enqueue(
-        "tasks.separate_with_demucs",
-        project_id,
-        job_id,
-        job_id=job_id,
-        job_timeout=3600,
-    )
+    job_id = enqueue_with_status("tasks.separate_with_demucs", project_id, message="Separation queued")
 
     return CreateJobResponse(job_id=job_id)
 
@@ -174,37 +250,26 @@ def transcribe(project_id: str, body: TranscribeRequest):
     if not stem_path.exists():
         raise HTTPException(status_code=400, detail=f"Stem not found: {body.stem_name}")
 
-    job_id = str(uuid.uuid4())
-    redis_conn.hset(job_key(job_id), mapping={
-        "state": "queued",
-        "progress": 0,
-        "message": f"Transcription queued ({body.stem_name})",
-        "project_id": project_id
-    })
-
-    q.enqueue(
+    job_id = enqueue_with_status(
         "tasks.transcribe_monophonic",
         project_id,
-        job_id,
         body.stem_name,
         body.instrument,
-        job_id=job_id,
-        job_timeout=3600,
+        message=f"Transcription queued ({body.stem_name})",
     )
     return CreateJobResponse(job_id=job_id)
 
 @app.get("/jobs/{job_id}", response_model=JobStatusResponse)
-def get_job_status(job_id: str):
-    data = redis_conn.hgetall(job_key(job_id))
-    if not data:
+async def get_job_status(job_id: str):
+    state, progress, message = await aioredis.hmget(job_key(job_id), "state", "progress", "message")
+    if state is None and progress is None and message is None:
         return JobStatusResponse(job_id=job_id, state="not_found", progress=0, message="Job not found")
 
-    decoded = {k.decode(): v.decode() for k, v in data.items()}
     return JobStatusResponse(
         job_id=job_id,
-        state=decoded.get("state", "unknown"),
-        progress=int(decoded.get("progress", "0")),
-        message=decoded.get("message"),
+        state=state or "unknown",
+        progress=int(progress or "0"),
+        message=message,
     )
 
 @app.get("/projects/{project_id}/stems", response_model=list[StemItem])
@@ -214,8 +279,9 @@ def list_stems(project_id: str):
         raise HTTPException(status_code=404, detail="Project not found")
 
     items: list[StemItem] = []
-    for p in sorted(sdir.glob("*.wav")):
-        items.append(StemItem(name=p.name, url=f"/files/{project_id}/stems/{p.name}"))
+    for name, version in cached_listing(_list_stems_versioned, sdir):
+        # versioned URL: a re-separated stem gets a new URL, so "immutable" caching stays correct
+        items.append(StemItem(name=name, url=f"/files/{project_id}/stems/{name}?v={version}"))
     return items
 
 @app.get("/projects/{project_id}/transcriptions", response_model=list[TranscriptionItem])
@@ -224,9 +290,8 @@ def list_transcriptions(project_id: str):
     if not tdir.exists():
         return []
     items: list[TranscriptionItem] = []
-    for p in sorted(tdir.iterdir()):
-        if p.is_file() and p.name.lower().endswith((".mid", ".midi", ".musicxml", ".xml")):
-            items.append(TranscriptionItem(name=p.name, url=f"/files/{project_id}/transcriptions/{p.name}"))
+    for name in cached_listing(_list_transcription_names, tdir):
+        items.append(TranscriptionItem(name=name, url=f"/files/{project_id}/transcriptions/{name}"))
     return items
 
 
@@ -246,15 +311,27 @@ def get_stem_file(project_id: str, filename: str, request: Request):
     if not p.exists():
         raise HTTPException(status_code=404, detail="File not found")
 
-    file_size = p.stat().st_size
+    st = p.stat()
+    file_size = st.st_size
+    version = stem_version(st)
+    etag = f'"{version}"'
+    versioned = request.query_params.get("v") == version
+    cache_headers = {
+        "ETag": etag,
+        "Cache-Control": STEM_CACHE_CONTROL_VERSIONED if versioned else STEM_CACHE_CONTROL_BARE,
+    }
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=cache_headers)
+
     range_header = request.headers.get("range")
 
     if not range_header:
-        return FileResponse(str(p), filename=filename, media_type="audio/x-wav")
+        return FileResponse(str(p), filename=filename, media_type="audio/x-wav", headers=cache_headers)
 
-    m = re.match(r"bytes=(\d*)-(\d*)", range_header)
+    m = RE_RANGE.match(range_header)
     if not m:
-        return FileResponse(str(p), filename=filename, media_type="audio/x-wav")
+        return FileResponse(str(p), filename=filename, media_type="audio/x-wav", headers=cache_headers)
 
     start_s, end_s = m.group(1), m.group(2)
     start = int(start_s) if start_s else 0
@@ -264,16 +341,12 @@ def get_stem_file(project_id: str, filename: str, request: Request):
     end = max(start, min(end, file_size - 1))
     chunk_size = end - start + 1
 
-    with p.open("rb") as f:
-        f.seek(start)
-        data = f.read(chunk_size)
-
     headers = {
         "Content-Range": f"bytes {start}-{end}/{file_size}",
         "Accept-Ranges": "bytes",
         "Content-Length": str(chunk_size),
         "Content-Disposition": f'inline; filename="{filename}"',
-        "Cache-Control": "no-store",
+        **cache_headers,
     }
 
-    return Response(content=data, status_code=206, media_type="audio/x-wav", headers=headers)
+    return StreamingResponse(iter_file_range(p, start, end), status_code=206, media_type="audio/x-wav", headers=headers)
@@ -2,9 +2,17 @@ import os
 import re
 import shutil
 import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
 from pathlib import Path
 from redis import Redis
 
+import librosa
+import numpy as np
+import pretty_midi
+from numba import njit
+
 REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
 DATA_DIR = Path(os.getenv("DATA_DIR", "/data"))
 redis_conn = Redis.from_url(REDIS_URL)
@@ -33,9 +41,57 @@ def find_stem_folder(tmp_out: Path) -> Path | None:
     candidates.sort(key=lambda t: t[0], reverse=True)
     return candidates[0][1]
 
+def move_file(src: Path, dst: Path):
+    # tmp_demucs and stems both live under DATA_DIR, so this is normally a rename
+    try:
+        os.replace(src, dst)
+    except OSError:
+        # copy next to dst, then rename: dst is never rewritten in place, which
+        # keeps the API's stems-dir-mtime listing cache valid
+        tmp = dst.with_name(f".{dst.name}.tmp")
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+        src.unlink(missing_ok=True)
+
 RE_TQDM_PCT = re.compile(r"^\s*(\d{1,3})%\|")  # lines like " 65%|████..."
 RE_TQDM_FRAC = re.compile(r"(\d+(?:\.\d+)?)/(\d+(?:\.\d+)?)")  # fallback "152.1/234.0"
 
+RE_LINE_SPLIT = re.compile(rb"[\r\n]")  # tqdm redraws with \r, logs end with \n
+
+def iter_output_lines(stream, chunk_size: int = 1 << 16):
+    """
+    Yield raw lines (bytes) from a binary pipe, splitting on both \r and \n.
+    Chunks are echoed to our stdout as-is so worker logs keep the demucs output.
+    """
+    buf = b""
+    while True:
+        chunk = stream.read1(chunk_size)
+        if not chunk:
+            break
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+        parts = RE_LINE_SPLIT.split(buf + chunk)
+        buf = parts.pop()
+        yield from parts
+    if buf:
+        yield buf
+
+def parse_tqdm_pct(raw: bytes) -> int | None:
+    # cheap substring test first: most demucs log lines carry no progress at all
+    if b"%|" not in raw and b"/" not in raw:
+        return None
+    line = raw.decode("utf-8", "replace")
+    m = RE_TQDM_PCT.match(line)
+    if m:
+        return int(m.group(1))
+    mf = RE_TQDM_FRAC.search(line)
+    if mf:
+        x = float(mf.group(1))
+        total = float(mf.group(2))
+        if total > 0:
+            return int((x / total) * 100)
+    return None
+
 def clamp(n: int, lo: int, hi: int) -> int:
     return max(lo, min(hi, n))
 
@@ -45,6 +101,8 @@ def set_progress(job_id: str, progress: int, message: str | None = None):
         mapping["message"] = message
     redis_conn.hset(job_key(job_id), mapping=mapping)
 
+PROGRESS_MIN_INTERVAL = 0.25  # seconds between progress writes while demucs runs
+
 def separate_with_demucs(project_id: str, job_id: str):
     set_progress(job_id, 1, "Preparing Demucs...")
 
@@ -71,34 +129,31 @@ def separate_with_demucs(project_id: str, job_id: str):
 
     last_scaled = -1
     rc = 1
+    pending = None  # latest (progress, message) not yet written
+    last_flush = time.monotonic()
 
     try:
         # NOTE: demucs tqdm sometimes writes to stderr; we redirect stderr->stdout
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1 << 16)
         assert proc.stdout is not None
 
-        for raw in proc.stdout:
-            line = raw.rstrip("\n")
-            print(line, flush=True)
-
-            pct = None
-            m = RE_TQDM_PCT.match(line)
-            if m:
-                pct = int(m.group(1))
-            else:
-                mf = RE_TQDM_FRAC.search(line)
-                if mf:
-                    x = float(mf.group(1))
-                    total = float(mf.group(2))
-                    if total > 0:
-                        pct = int((x / total) * 100)
-
+        for raw in iter_output_lines(proc.stdout):
+            pct = parse_tqdm_pct(raw)
             if pct is not None:
                 pct = clamp(pct, 0, 100)
                 scaled = 5 + int((pct / 100) * 80)  # 5..85
                 if scaled != last_scaled:
                     last_scaled = scaled
-                    set_progress(job_id, scaled, f"Separating… {pct}%")
+                    pending = (scaled, f"Separating… {pct}%")
+
+            # each write overwrites the same fields, so only the newest value per tick is sent
+            if pending and time.monotonic() - last_flush >= PROGRESS_MIN_INTERVAL:
+                set_progress(job_id, *pending)
+                pending = None
+                last_flush = time.monotonic()
+
+        if pending:
+            set_progress(job_id, *pending)
 
         rc = proc.wait()
 
@@ -127,7 +182,7 @@ def separate_with_demucs(project_id: str, job_id: str):
     for name in expected:
         src_stem = stem_folder / name
         if src_stem.exists():
-            shutil.copyfile(src_stem, sdir / name)
+            move_file(src_stem, sdir / name)
             copied += 1
 
     if copied == 0:
@@ -141,13 +196,180 @@ def separate_with_demucs(project_id: str, job_id: str):
 # ---------------------------
 # Transcription (monophonic)
 # ---------------------------
-import numpy as np
+# pyin search range, resolved once at import
+FMIN_BASS = librosa.note_to_hz("E1")
+FMIN_GUITAR = librosa.note_to_hz("E2")
+FMAX = librosa.note_to_hz("C5")
+# C5 is ~523 Hz, so 8 kHz (4 kHz Nyquist) keeps fundamentals plus harmonics
+# while giving pyin ~2.75x fewer samples than 22.05 kHz
+PYIN_SR = 8000
+PYIN_FRAME_LENGTH = 1024
+PYIN_HOP_LENGTH = 128
 
 def transcriptions_dir(project_id: str) -> Path:
     return DATA_DIR / "projects" / project_id / "transcriptions"
 
-def hz_to_midi(hz: float) -> int:
-    return int(round(69 + 12 * np.log2(hz / 440.0)))
+def hz_to_midi(hz: np.ndarray) -> np.ndarray:
+    """Vectorized Hz -> MIDI number; NaN (unvoiced) frames map to -1."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        m = np.rint(69.0 + 12.0 * np.log2(hz / 440.0))
+    return np.where(np.isnan(hz), -1, m).astype(np.int32)
+
+@njit(cache=True)
+def smooth_midi_frames(midi_frame: np.ndarray, width: int = 5, min_voiced: int = 3) -> np.ndarray:
+    """
+    Median filter over voiced frames only (unvoiced = -1 is ignored).
+    A frame is replaced only when its window has at least `min_voiced` voiced frames.
+    """
+    out = midi_frame.copy()
+    half = width // 2
+    buf = np.empty(width, dtype=midi_frame.dtype)
+    for i in range(half, len(midi_frame) - half):
+        # insertion-sort the voiced values of the window into buf[:k]
+        k = 0
+        for j in range(i - half, i + half + 1):
+            v = midi_frame[j]
+            if v >= 0:
+                p = k
+                while p > 0 and buf[p - 1] > v:
+                    buf[p] = buf[p - 1]
+                    p -= 1
+                buf[p] = v
+                k += 1
+        if k >= min_voiced:
+            if k % 2 == 1:
+                out[i] = buf[k // 2]
+            else:
+                out[i] = (buf[k // 2 - 1] + buf[k // 2]) // 2
+    return out
+
+def group_notes(midi_frame: np.ndarray, times: np.ndarray, min_note_len_s: float) -> list[tuple[int, float, float]]:
+    """Run-length encode voiced frames into (pitch, start_s, end_s) notes."""
+    if len(midi_frame) == 0:
+        return []
+    hop_s = float(times[1] - times[0]) if len(times) > 1 else 0.01
+
+    starts = np.flatnonzero(np.diff(midi_frame, prepend=midi_frame[0] - 1))
+    ends = np.append(starts[1:], len(midi_frame)) - 1  # last frame of each run
+    pitches = midi_frame[starts]
+
+    start_t = times[starts]
+    end_t = times[ends] + hop_s
+    keep = (pitches >= 0) & (end_t - start_t >= min_note_len_s)
+
+    return [(int(p), float(a), float(b)) for p, a, b in zip(pitches[keep], start_t[keep], end_t[keep])]
+
+# ---------------------------
+# MusicXML export (monophonic)
+# ---------------------------
+MUSICXML_DOCTYPE = (
+    b'<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 4.0 Partwise//EN" '
+    b'"http://www.musicxml.org/dtds/partwise.dtd">\n'
+)
+PITCH_NAMES = [("C", 0), ("C", 1), ("D", 0), ("D", 1), ("E", 0), ("F", 0),
+               ("F", 1), ("G", 0), ("G", 1), ("A", 0), ("A", 1), ("B", 0)]
+# duration (in 16ths) -> (type, dotted); greedy order, largest first
+NOTE_VALUES = [(16, "whole", False), (12, "half", True), (8, "half", False), (6, "quarter", True),
+               (4, "quarter", False), (3, "eighth", True), (2, "eighth", False), (1, "16th", False)]
+
+def notes_to_musicxml(notes: list[tuple[int, float, float]], instrument: str, bpm: int = 120) -> bytes:
+    """
+    Minimal single-part MusicXML: 4/4, notes quantized to a 16th grid,
+    gaps filled with rests, notes tied across barlines.
+    """
+    divisions = 4  # per quarter -> one division is a 16th
+    measure_len = 4 * divisions
+    ticks_per_s = bpm / 60 * divisions
+
+    # quantize into a monophonic list of (start_tick, end_tick, pitch | None)
+    events: list[tuple[int, int, int | None]] = []
+    cursor = 0
+    for pitch, start, end in notes:
+        s = max(int(round(start * ticks_per_s)), cursor)
+        e = max(int(round(end * ticks_per_s)), s + 1)
+        if s > cursor:
+            events.append((cursor, s, None))
+        events.append((s, e, int(pitch)))
+        cursor = e
+    if cursor % measure_len:
+        events.append((cursor, cursor + measure_len - cursor % measure_len, None))
+
+    root = ET.Element("score-partwise", version="4.0")
+    part_list = ET.SubElement(root, "part-list")
+    score_part = ET.SubElement(part_list, "score-part", id="P1")
+    ET.SubElement(score_part, "part-name").text = instrument
+    part = ET.SubElement(root, "part", id="P1")
+
+    measures: dict[int, ET.Element] = {}
+
+    def measure(idx: int) -> ET.Element:
+        if idx not in measures:
+            m = ET.SubElement(part, "measure", number=str(idx + 1))
+            if idx == 0:
+                attrs = ET.SubElement(m, "attributes")
+                ET.SubElement(attrs, "divisions").text = str(divisions)
+                key = ET.SubElement(attrs, "key")
+                ET.SubElement(key, "fifths").text = "0"
+                time_sig = ET.SubElement(attrs, "time")
+                ET.SubElement(time_sig, "beats").text = "4"
+                ET.SubElement(time_sig, "beat-type").text = "4"
+                clef = ET.SubElement(attrs, "clef")
+                if instrument == "bass":
+                    ET.SubElement(clef, "sign").text = "F"
+                    ET.SubElement(clef, "line").text = "4"
+                else:
+                    ET.SubElement(clef, "sign").text = "G"
+                    ET.SubElement(clef, "line").text = "2"
+                    ET.SubElement(clef, "clef-octave-change").text = "-1"
+                ET.SubElement(m, "sound", tempo=str(bpm))
+            measures[idx] = m
+        return measures[idx]
+
+    for start, end, pitch in events:
+        # split at barlines, then into notatable values; consecutive pieces are tied
+        pieces: list[tuple[int, int]] = []
+        t = start
+        while t < end:
+            bar_end = (t // measure_len + 1) * measure_len
+            seg_end = min(end, bar_end)
+            remaining = seg_end - t
+            for ticks, _, _ in NOTE_VALUES:
+                while remaining >= ticks:
+                    pieces.append((t, ticks))
+                    t += ticks
+                    remaining -= ticks
+
+        for n, (t, ticks) in enumerate(pieces):
+            note = ET.SubElement(measure(t // measure_len), "note")
+            if pitch is None:
+                ET.SubElement(note, "rest")
+            else:
+                step, alter = PITCH_NAMES[pitch % 12]
+                p = ET.SubElement(note, "pitch")
+                ET.SubElement(p, "step").text = step
+                if alter:
+                    ET.SubElement(p, "alter").text = str(alter)
+                ET.SubElement(p, "octave").text = str(pitch // 12 - 1)
+            ET.SubElement(note, "duration").text = str(ticks)
+            tie_stop, tie_start = pitch is not None and n > 0, pitch is not None and n < len(pieces) - 1
+            if tie_stop:
+                ET.SubElement(note, "tie", type="stop")
+            if tie_start:
+                ET.SubElement(note, "tie", type="start")
+            ET.SubElement(note, "voice").text = "1"
+            _, note_type, dotted = next(v for v in NOTE_VALUES if v[0] == ticks)
+            ET.SubElement(note, "type").text = note_type
+            if dotted:
+                ET.SubElement(note, "dot")
+            if tie_stop or tie_start:
+                notations = ET.SubElement(note, "notations")
+                if tie_stop:
+                    ET.SubElement(notations, "tied", type="stop")
+                if tie_start:
+                    ET.SubElement(notations, "tied", type="start")
+
+    body = ET.tostring(root, encoding="unicode").encode("utf-8")
+    return b'<?xml version="1.0" encoding="UTF-8"?>\n' + MUSICXML_DOCTYPE + body
 
 def transcribe_monophonic(project_id: str, job_id: str, stem_name: str = "bass.wav", instrument: str = "bass"):
     """
@@ -155,7 +377,7 @@ def transcribe_monophonic(project_id: str, job_id: str, stem_name: str = "bass.w
     - Monophonic pitch tracking (librosa.pyin)
     - Group contiguous frames into notes
     - Export MIDI (pretty_midi)
-    - Convert to MusicXML (music21)
+    - Export MusicXML (notes_to_musicxml)
     """
     try:
         set_progress(job_id, 1, "Preparing transcription...")
@@ -170,11 +392,7 @@ def transcribe_monophonic(project_id: str, job_id: str, stem_name: str = "bass.w
 
         set_progress(job_id, 5, "Loading audio...")
 
-        import librosa
-        import pretty_midi
-        import music21 as m21
-
-        y, sr = librosa.load(str(sfile), sr=22050, mono=True)
+        y, sr = librosa.load(str(sfile), sr=PYIN_SR, mono=True)
 
         # Light denoise / trim silence
         y, _ = librosa.effects.trim(y, top_db=35)
@@ -184,49 +402,25 @@ def transcribe_monophonic(project_id: str, job_id: str, stem_name: str = "bass.w
         # pyin: monophonic fundamental frequency estimation
         f0, voiced_flag, voiced_prob = librosa.pyin(
             y,
-            fmin=librosa.note_to_hz("E1") if instrument == "bass" else librosa.note_to_hz("E2"),
-            fmax=librosa.note_to_hz("C5"),
+            fmin=FMIN_BASS if instrument == "bass" else FMIN_GUITAR,
+            fmax=FMAX,
             sr=sr,
-            frame_length=2048,
-            hop_length=256,
+            frame_length=PYIN_FRAME_LENGTH,
+            hop_length=PYIN_HOP_LENGTH,
         )
 
-        times = librosa.times_like(f0, sr=sr, hop_length=256)
+        times = librosa.times_like(f0, sr=sr, hop_length=PYIN_HOP_LENGTH)
 
         # Convert to MIDI notes per frame (NaN when unvoiced)
-        midi_frame = np.full_like(f0, fill_value=-1, dtype=np.int32)
-        for i, hz in enumerate(f0):
-            if hz is not None and not np.isnan(hz):
-                midi_frame[i] = hz_to_midi(float(hz))
+        midi_frame = hz_to_midi(np.asarray(f0, dtype=np.float64))
 
         # Smooth: median filter-ish (reduce jitter)
-        # simple: replace isolated spikes
-        for i in range(2, len(midi_frame) - 2):
-            window = midi_frame[i-2:i+3]
-            vals = window[window >= 0]
-            if len(vals) >= 3:
-                median = int(np.median(vals))
-                midi_frame[i] = median
+        midi_frame = smooth_midi_frames(midi_frame)
 
         set_progress(job_id, 35, "Building notes...")
 
         # Group contiguous frames of same midi into notes
-        notes = []
-        i = 0
-        min_note_len_s = 0.06  # discard tiny blips
-        while i < len(midi_frame):
-            if midi_frame[i] < 0:
-                i += 1
-                continue
-            note = int(midi_frame[i])
-            start_t = float(times[i])
-            j = i + 1
-            while j < len(midi_frame) and midi_frame[j] == note:
-                j += 1
-            end_t = float(times[j-1]) + (times[1] - times[0] if len(times) > 1 else 0.01)
-            if end_t - start_t >= min_note_len_s:
-                notes.append((note, start_t, end_t))
-            i = j
+        notes = group_notes(midi_frame, times, min_note_len_s=0.06)  # discard tiny blips
 
         if not notes:
             redis_conn.hset(job_key(job_id), mapping={"state": "failed", "progress": "0", "message": "No notes detected (try bass stem, or cleaner audio)."})
@@ -247,10 +441,9 @@ def transcribe_monophonic(project_id: str, job_id: str, stem_name: str = "bass.w
 
         set_progress(job_id, 75, "Converting to MusicXML...")
 
-        # music21 conversion
-        score = m21.converter.parse(str(midi_path))
+        # pretty_midi writes at its default 120 bpm, so the MusicXML uses the same grid
         xml_path = out_dir / f"{stem_name.replace('.wav','')}.musicxml"
-        score.write("musicxml", fp=str(xml_path))
+        xml_path.write_bytes(notes_to_musicxml(notes, instrument, bpm=120))
 
         redis_conn.hset(job_key(job_id), mapping={"state": "succeeded", "progress": "100", "message": "Transcription ready (MIDI + MusicXML)."})
         return
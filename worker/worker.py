@@ -4,7 +4,30 @@ from rq import Worker, Queue, Connection
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
+def warmup():
+    """
+    Import the task module (librosa, pretty_midi, numba kernels) and run the
+    JIT-compiled paths once, so forked job processes start warm.
+    """
+    import numpy as np
+    import librosa
+    import tasks
+
+    try:
+        librosa.pyin(
+            np.zeros(2 * tasks.PYIN_FRAME_LENGTH, dtype=np.float32),
+            fmin=tasks.FMIN_BASS,
+            fmax=tasks.FMAX,
+            sr=tasks.PYIN_SR,
+            frame_length=tasks.PYIN_FRAME_LENGTH,
+            hop_length=tasks.PYIN_HOP_LENGTH,
+        )
+        tasks.smooth_midi_frames(np.full(8, -1, dtype=np.int32))
+    except Exception as e:
+        print("Warmup failed (continuing):", e, flush=True)
+
 if __name__ == "__main__":
+    warmup()
     redis_conn = Redis.from_url(REDIS_URL)
     with Connection(redis_conn):
         worker = Worker([Queue("default")])